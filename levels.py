@@ -0,0 +1,142 @@
+import mmap
+import struct
+import sys
+import pygame
+
+MAGIC = "LD2M"
+VERSION = 1
+
+# Colors in the map image that mean "put a thing here" rather than a tile, and
+# what they're called in a level file. See Map.parse for what each one makes.
+SPAWNS = [((255, 0, 0), "enemy"),
+          ((100, 0, 0), "enemy_reverse"),
+          ((0, 255, 0), "rotator"),
+          ((255, 255, 0), "treasure"),
+          ((150, 90, 60), "dialog"),
+          ((0, 0, 255), "stairs"),
+          ((200, 200, 0), "replicator"),
+          ((200, 255, 0), "escaper"),
+          ((150, 150, 150), "signpost1"),
+          ((151, 150, 150), "signpost2"),
+          ((200, 200, 200), "boss")]
+KINDS = [kind for color, kind in SPAWNS]
+
+# Tiles in wall.png, by the color that means them in the map image.
+TILES = [((255, 255, 255), (0, 0)), # nothing
+         ((0, 0, 0), (1, 0))]       # wall
+WALL = 1 # index into TILES
+NO_TILE = 255
+
+HEADER = struct.Struct("<4sHBBB") # magic, version, rooms across, rooms down, tiles per room side
+OFFSET = struct.Struct("<I")      # where each room starts, row by row
+COUNT = struct.Struct("<H")       # how many things in a room
+SPAWN = struct.Struct("<BBB")     # tile x, tile y, index into KINDS
+
+# Each room is: the wall bits (1 per tile, row by row), one index into TILES
+# per tile, then COUNT and that many SPAWNs.
+
+def compile_level(image_name, level_name, room_size=20):
+  """ Turn a map image (a grid of room_size x room_size rooms, one pixel per
+  tile) into a level file. """
+  image = pygame.image.load(image_name)
+  width, height = image.get_size()
+  across, down = width // room_size, height // room_size
+
+  colors = dict((color, i) for i, (color, tile) in enumerate(TILES))
+  kinds = dict((color, i) for i, (color, kind) in enumerate(SPAWNS))
+
+  rooms = []
+  for my in range(down):
+    for mx in range(across):
+      walls = bytearray((room_size * room_size + 7) // 8)
+      tiles = bytearray()
+      spawns = []
+
+      for y in range(room_size):
+        for x in range(room_size):
+          color = tuple(image.get_at((mx * room_size + x, my * room_size + y)))[:3]
+          if color in kinds:
+            spawns.append(SPAWN.pack(x, y, kinds[color]))
+            color = TILES[0][0]
+
+          tile = colors.get(color, NO_TILE)
+          if tile == WALL:
+            i = y * room_size + x
+            walls[i // 8] |= 1 << (i % 8)
+          tiles.append(tile)
+
+      rooms.append(str(walls) + str(tiles) + COUNT.pack(len(spawns)) + "".join(spawns))
+
+  offset = HEADER.size + OFFSET.size * len(rooms)
+  offsets = []
+  for room in rooms:
+    offsets.append(OFFSET.pack(offset))
+    offset += len(room)
+
+  out = open(level_name, "wb")
+  out.write(HEADER.pack(MAGIC, VERSION, across, down, room_size))
+  out.write("".join(offsets))
+  out.write("".join(rooms))
+  out.close()
+
+class Level:
+  """ A level file, mapped into memory. Rooms are only unpacked when someone
+  asks for them. Memoized like TileSheet, so each file is opened once. """
+  loaded = {}
+
+  @staticmethod
+  def get(file_name):
+    if file_name not in Level.loaded:
+      Level.loaded[file_name] = Level(file_name)
+    return Level.loaded[file_name]
+
+  def __init__(self, file_name):
+    try:
+      self.file = open(file_name, "rb")
+    except IOError:
+      raise ValueError("Can't find %s. Make it with: python levels.py map.png %s" % (file_name, file_name))
+
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self.data) < HEADER.size:
+      raise ValueError("%s is not a level file." % file_name)
+
+    magic, version, self.across, self.down, self.room_size = HEADER.unpack_from(self.data)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a version %d level file." % (file_name, VERSION))
+
+  def has_room(self, x, y):
+    return 0 <= x < self.across and 0 <= y < self.down
+
+  def room(self, x, y):
+    """ Returns (walls, tiles, spawns) for a room. walls is a bytearray with 1
+    for every wall tile, tiles is the (x, y) in wall.png for every tile, both
+    row by row, and spawns is a list of ((x, y), kind). """
+    if not self.has_room(x, y):
+      raise ValueError("There's no room (%d, %d) in this level." % (x, y))
+
+    size = self.room_size
+    start = OFFSET.unpack_from(self.data, HEADER.size + OFFSET.size * (y * self.across + x))[0]
+
+    bits = bytearray(self.data[start:start + (size * size + 7) // 8])
+    walls = bytearray((bits[i // 8] >> (i % 8)) & 1 for i in range(size * size))
+    start += len(bits)
+
+    tiles = [TILES[i][1] if i != NO_TILE else None for i in bytearray(self.data[start:start + size * size])]
+    start += size * size
+
+    count = COUNT.unpack_from(self.data, start)[0]
+    start += COUNT.size
+
+    spawns = []
+    for i in range(count):
+      x, y, kind = SPAWN.unpack_from(self.data, start + i * SPAWN.size)
+      spawns.append(((x, y), KINDS[kind]))
+
+    return walls, tiles, spawns
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print "usage: python levels.py map.png map.lvl"
+    sys.exit(1)
+
+  compile_level(sys.argv[1], sys.argv[2])
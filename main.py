@@ -1,24 +1,37 @@
 import sys, pygame, time
 import time
 import math
+import os
+import argparse
+import hashlib
 import random
+import bisect
 import spritesheet
+from collections import OrderedDict
 from wordwrap import render_textrect
+from replay import InputRecorder, InputReplay
+from levels import Level
 
 DEBUG = False
 
 # constants
 
 GAME_SIZE = 2
+DIRTY_RECTS = True # Only redraw and present the parts of the screen that changed.
+NATIVE_SCALE = True # Draw straight onto the window at GAME_SIZE, instead of scaling up a 400x400 frame.
+TICK_RATE = 50 # Simulation steps per second. All the physics is per tick.
+MAX_FRAME_SKIP = 5 # Most ticks we'll run to catch up before drawing regardless.
+RENDER_RATE = None # Frames per second to draw at, or None to draw whenever we ticked.
+SHOW_STATS = DEBUG # Show ticks/sec and frame time jitter in the title bar.
+PARTICLES = True # Ambient particles floating up through the rooms.
+MAX_PARTICLES = 256 # Most particles there can be at once, from all the generators together.
+ROTATION_STEP = 2 # Degrees between the copies in a sprite's rotation atlas. Should divide 360.
 
-WALLS = [(0,0,0)]
 TILE_SIZE = 20
 MAP_SIZE = 20
 DEATH_COUNT = 0
 START_TIME = time.time()
 
-NOTHING_COLOR = (255, 255, 255)
-
 ABS_MAP_SIZE = TILE_SIZE * MAP_SIZE
 
 # images
@@ -31,6 +44,16 @@ land_sound = None
 get_sound = None
 escape_sound = None
 
+class NullSound:
+  """ Stands in for a pygame.mixer.Sound when we're running without a mixer. """
+  def play(self, *args):
+    pass
+
+class NoKeys:
+  """ Stands in for pygame.key.get_pressed() when nobody is at the keyboard. """
+  def __getitem__(self, key):
+    return False
+
 # Following 2 methods found online.
 def rot_center(image, angle):
     """rotate an image while keeping its center and size"""
@@ -41,24 +64,27 @@ def rot_center(image, angle):
     rot_image = rot_image.subsurface(rot_rect).copy()
     return rot_image
 
-def blur_surf(surface, amt):
+def blur_scale(surface, amt):
+    """the size blur_surf shrinks surface down to"""
+    scale = 1.0/float(amt)
+    surf_size = surface.get_size()
+    return (int(surf_size[0]*scale), int(surf_size[1]*scale))
+
+def blur_surf(surface, amt, small=None, dest=None):
+    """small and dest, if given, are surfaces to do the work in (of size
+    blur_scale(surface, amt) and surface's size), so nothing gets allocated"""
     if amt < 1.0:
         raise ValueError("Arg 'amt' must be greater than 1.0, passed in value is %s"%amt)
-    scale = 1.0/float(amt)
+    scale_size = blur_scale(surface, amt)
     surf_size = surface.get_size()
-    scale_size = (int(surf_size[0]*scale), int(surf_size[1]*scale))
-    surf = pygame.transform.smoothscale(surface, scale_size)
-    surf = pygame.transform.smoothscale(surf, surf_size)
-    return surf
-
-def get_touching(x_abs, y_abs):
-  """If a thing's upper (x,y) coords are x_abs, y_abs, then what tiles will
-  it be touching?"""
-  result = []
-  for x in range((x_abs + 2)/TILE_SIZE, (x_abs + TILE_SIZE - 2)/TILE_SIZE + 1):
-    for y in range((y_abs + 2)/TILE_SIZE, (y_abs + TILE_SIZE - 2)/TILE_SIZE + 1):
-      result.append([x,y])
-  return result
+    if small is None:
+        small = pygame.transform.smoothscale(surface, scale_size)
+    else:
+        pygame.transform.smoothscale(surface, scale_size, small)
+    if dest is None:
+        return pygame.transform.smoothscale(small, surf_size)
+    pygame.transform.smoothscale(small, surf_size, dest)
+    return dest
 
 # do objects with upper-rt corners as given by x.x, x.y etc touch?
 def generic_touching(one, two):
@@ -81,6 +107,83 @@ def point_touch_rect(pt, rect):
   return rect.x <= pt.x <= rect.x + TILE_SIZE and\
          rect.y <= pt.y <= rect.y + TILE_SIZE
 
+# Swept collision. Instead of moving a pixel at a time and asking touching_wall
+# after every step, collect the ranges of positions along the axis we're moving
+# on where touching_wall (walls and dead bodies) would say yes, and go
+# straight to the answer. Positions are whole pixels and ranges are inclusive.
+def blocked_along_y(x, low, high, game_map, uid=-1):
+  """ Where between y = low and y = high would a thing at x touch a wall or
+  one of your dead bodies? """
+  ranges = []
+
+  # A wall tile in row r is touched from r * TILE_SIZE - 18 to r * TILE_SIZE + 17.
+  for column in set([(x + 2) // TILE_SIZE, (x + TILE_SIZE - 2) // TILE_SIZE]):
+    for row in range((low + 2) // TILE_SIZE, (high + TILE_SIZE - 2) // TILE_SIZE + 1):
+      if game_map.is_wall(column, row):
+        ranges.append((row * TILE_SIZE - (TILE_SIZE - 2), row * TILE_SIZE + TILE_SIZE - 3))
+
+  # Same corners as generic_touching: +0 and +16.
+  for obj in Updater.grid.query(x - TILE_SIZE, low - TILE_SIZE, 2 * TILE_SIZE, high - low + 2 * TILE_SIZE):
+    if isinstance(obj, Replicated) and obj.uid != uid and x - 16 <= obj.x <= x + TILE_SIZE:
+      ranges.append((obj.y - TILE_SIZE, obj.y + 16))
+
+  return ranges
+
+def blocked_along_x(y, low, high, game_map, uid=-1):
+  """ Where between x = low and x = high would a thing at y touch a wall or
+  one of your dead bodies? """
+  ranges = []
+
+  for row in set([(y + 2) // TILE_SIZE, (y + TILE_SIZE - 2) // TILE_SIZE]):
+    for column in range((low + 2) // TILE_SIZE, (high + TILE_SIZE - 2) // TILE_SIZE + 1):
+      if game_map.is_wall(column, row):
+        ranges.append((column * TILE_SIZE - (TILE_SIZE - 2), column * TILE_SIZE + TILE_SIZE - 3))
+
+  for obj in Updater.grid.query(low - TILE_SIZE, y - TILE_SIZE, high - low + 2 * TILE_SIZE, 2 * TILE_SIZE):
+    if isinstance(obj, Replicated) and obj.uid != uid and y - 16 <= obj.y <= y + TILE_SIZE:
+      ranges.append((obj.x - TILE_SIZE, obj.x + 16))
+
+  return ranges
+
+def first_contact(start, delta, ranges):
+  """ Moving a pixel at a time from start towards start + delta, how many
+  steps until we're inside one of ranges? None if we never are. """
+  direction = sign(delta)
+  first = None
+
+  for low, high in ranges:
+    if direction > 0:
+      steps = max(1, low - start)
+      hit = start + steps <= high
+    else:
+      steps = max(1, start - high)
+      hit = start - steps >= low
+
+    if hit and steps <= abs(delta) and (first is None or steps < first):
+      first = steps
+
+  return first
+
+def back_off(x, y, direction, game_map, uid=-1):
+  """ Keep stepping x in direction until a thing at (x, y) isn't touching a
+  wall or body any more. """
+  if direction == 0: return x
+
+  while True:
+    ranges = [r for r in blocked_along_x(y, x, x, game_map, uid) if r[0] <= x <= r[1]]
+    if not ranges: return x
+
+    if direction < 0:
+      x = min(low for low, high in ranges) - 1
+    else:
+      x = max(high for low, high in ranges) + 1
+
+def draw_scale():
+  """ How many window pixels each game pixel gets drawn as. """
+  if NATIVE_SCALE:
+    return GAME_SIZE
+  return 1
+
 def sign(x):
   if x > 0: return 1
   if x < 0: return -1
@@ -125,6 +228,7 @@ class BigImage:
 class Image:
   def __init__(self, src_file, src_x, src_y, dst_x, dst_y):
     self.old_values = (src_file, src_x, src_y)
+    self.flipped = (False, False)
 
     self.img = TileSheet.get(*self.old_values)
     self.rect = self.img.get_rect()
@@ -144,18 +248,18 @@ class Image:
     return self.rect.y
 
   def render(self, screen, scale = 1, rotation = 0):
+    img = self.img
     rect = self.rect
 
     if scale != 1:
-      self.img = pygame.transform.scale(self.img, (self.base_w * scale, self.base_h * scale))
-      rect[0] -= self.base_w / scale
-      rect[1] -= self.base_h / scale
+      img = TileSheet.get_scaled(*self.old_values + (scale,) + self.flipped)
+      rect = rect.move(-(self.base_w / scale), -(self.base_h / scale))
 
     if rotation != 0:
-      rotated = rot_center(self.img, rotation)
-      screen.blit(rotated, rect)
+      rotated = TileSheet.get_rotated(*self.old_values + (rotation, scale) + self.flipped)
+      DirtyRects.blit(screen, rotated, rect)
     else:
-      screen.blit(self.img, rect)
+      DirtyRects.blit(screen, img, rect)
 
   def move(self, new_x, new_y):
     self.rect.x = new_x
@@ -167,33 +271,185 @@ class Image:
       return
 
     self.old_values = new_values
-    self.img = TileSheet.get(*self.old_values)
+    self.img = TileSheet.get(*self.old_values + self.flipped)
+
+  def flip(self, flip_x, flip_y=False):
+    """ Mirror the sprite left to right and/or upside down. flip(False) puts
+    it back the way it was. """
+    self.flipped = (bool(flip_x), bool(flip_y))
+    self.img = TileSheet.get(*self.old_values + self.flipped)
+
+  def face(self, left_facing):
+    """ Sprites face left in the sheet. """
+    self.flip(not left_facing)
 
 class TileSheet:
   """ Memoize all the sheets so we don't load in 1 sheet like 50 times and 
   squander resources. This is a singleton, which is generally frowned upon, 
   but I think it's okay here."""
   sheets = {}
+  flipped = {} # (sheet, x, y, flip_x, flip_y) -> that tile, mirrored
+  scaled = {} # (sheet, x, y, scale, flip_x, flip_y) -> that tile, bigger
+  atlases = {} # sheet -> the surface all its tiles live in
+  rotated = {} # (sheet, x, y, scale, flip_x, flip_y) -> that tile every ROTATION_STEP degrees
+  native = {} # surface -> {GAME_SIZE: that surface, drawn at that size}
 
   @staticmethod
   def add(file_name):
     if file_name in TileSheet.sheets:
       return
 
-    new_sheet = spritesheet.spritesheet(file_name)
-    width, height = dimensions = new_sheet.sheet.get_size()
+    # The whole sheet is one surface, and the tiles are just windows into it
+    # (they pick up its color key too).
+    atlas = spritesheet.spritesheet(file_name).sheet
+    atlas.set_colorkey((255,255,255))
+    TileSheet.atlases[file_name] = atlas
+
+    width, height = dimensions = atlas.get_size()
     TileSheet.sheets[file_name] =\
-     [[new_sheet.image_at((x, y, TILE_SIZE, TILE_SIZE), colorkey=(255,255,255))\
+     [[atlas.subsurface(pygame.Rect(x, y, TILE_SIZE, TILE_SIZE).clip(atlas.get_rect()))\
        for y in range(0, height, TILE_SIZE)] for x in range(0, width, TILE_SIZE)]
 
+    # Things face left by default, so we'll want all of these facing right.
+    for x, column in enumerate(TileSheet.sheets[file_name]):
+      for y, tile in enumerate(column):
+        TileSheet.flipped[(file_name, x, y, True, False)] = pygame.transform.flip(tile, True, False)
+
   @staticmethod
-  def get(sheet, x, y):
+  def get(sheet, x, y, flip_x=False, flip_y=False):
+    """ The tile at (x, y), mirrored left to right if flip_x and upside down
+    if flip_y. """
     if sheet not in TileSheet.sheets:
       raise
-    return TileSheet.sheets[sheet][x][y]
+    if not flip_x and not flip_y:
+      return TileSheet.sheets[sheet][x][y]
+
+    key = (sheet, x, y, bool(flip_x), bool(flip_y))
+    if key not in TileSheet.flipped: # Upside down ones get made when they're first needed.
+      TileSheet.flipped[key] = pygame.transform.flip(TileSheet.sheets[sheet][x][y], key[3], key[4])
+    return TileSheet.flipped[key]
+
+  @staticmethod
+  def get_area(sheet, x, y):
+    """ The sheet's surface and where the tile at (x, y) is in it, for
+    screen.blit(surface, dest, area). """
+    if sheet not in TileSheet.sheets:
+      raise
+    tile = TileSheet.sheets[sheet][x][y]
+    return TileSheet.atlases[sheet], pygame.Rect(tile.get_offset(), tile.get_size())
+
+  @staticmethod
+  def get_scaled(sheet, x, y, scale, flip_x=False, flip_y=False):
+    """ The tile at (x, y), scale times as big. """
+    if scale == 1:
+      return TileSheet.get(sheet, x, y, flip_x, flip_y)
+
+    key = (sheet, x, y, scale, bool(flip_x), bool(flip_y))
+    if key not in TileSheet.scaled:
+      img = TileSheet.get(sheet, x, y, flip_x, flip_y)
+      TileSheet.scaled[key] = pygame.transform.scale(img, (img.get_width() * scale, img.get_height() * scale))
+    return TileSheet.scaled[key]
+
+  @staticmethod
+  def get_native(surface, scale):
+    """ Any surface (tile, rotated tile, rendered text), scale times as big.
+    Holds on to surface until forget_native, so don't use this for things
+    that are made fresh every frame. """
+    if scale == 1:
+      return surface
+
+    sizes = TileSheet.native.setdefault(surface, {})
+    if scale not in sizes:
+      sizes[scale] = pygame.transform.scale(surface, (surface.get_width() * scale, surface.get_height() * scale))
+    return sizes[scale]
+
+  @staticmethod
+  def forget_native(surface):
+    """ Drop the scaled up copies of surface, for when nobody's going to
+    draw it again. """
+    TileSheet.native.pop(surface, None)
+
+  @staticmethod
+  def get_rotated(sheet, x, y, angle, scale=1, flip_x=False, flip_y=False):
+    """ The tile at (x, y), scaled up by scale and rotated about its center by
+    angle (to the nearest ROTATION_STEP). Each angle is only rotated the first
+    time somebody asks for it. """
+    key = (sheet, x, y, scale, bool(flip_x), bool(flip_y))
+    if key not in TileSheet.rotated:
+      TileSheet.rotated[key] = [None] * (360 // ROTATION_STEP)
+
+    atlas = TileSheet.rotated[key]
+    step = int(round(float(angle) / ROTATION_STEP)) % len(atlas)
+    if atlas[step] is None:
+      atlas[step] = rot_center(TileSheet.get_scaled(sheet, x, y, scale, flip_x, flip_y), step * ROTATION_STEP)
+
+    return atlas[step]
+
+class Text:
+  """ Fonts and rendered text, memoized. Opening a font file and word wrapping
+  are way too slow to do every frame, and we mostly show the same few strings
+  over and over. Singleton like TileSheet. """
+  fonts = {}
+  rendered = OrderedDict() # least recently used first
+  max_rendered = 64
+
+  @staticmethod
+  def font(file_name, size):
+    if (file_name, size) not in Text.fonts:
+      Text.fonts[(file_name, size)] = pygame.font.Font(file_name, size)
+    return Text.fonts[(file_name, size)]
+
+  @staticmethod
+  def render(string, font_name, size, rect, text_color, background_color, fuzzy=False, justification=0):
+    """ render_textrect, but only the first time we see these arguments. Only
+    the size of rect matters. Don't draw on what you get back; it's shared. """
+    key = (string, font_name, size, tuple(rect.size), text_color, background_color, fuzzy, justification)
+    if key in Text.rendered:
+      surface = Text.rendered.pop(key)
+    else:
+      surface = render_textrect(string, Text.font(font_name, size), rect, text_color, background_color, fuzzy, justification)
+      if len(Text.rendered) >= Text.max_rendered:
+        old_key, old_surface = Text.rendered.popitem(last=False)
+        TileSheet.forget_native(old_surface)
+
+    Text.rendered[key] = surface
+    return surface
+
+class Room:
+  """ One room of a level: which tiles are walls, which tile to draw where, and
+  what to spawn on the first visit. Unpacked from the level file once and
+  never changed after that, so every visit (and every death) shares it. """
+  compiled = {}
+
+  @staticmethod
+  def get(file_name, coords):
+    key = (file_name, tuple(coords))
+    if key not in Room.compiled:
+      Room.compiled[key] = Room(file_name, coords)
+    return Room.compiled[key]
+
+  @staticmethod
+  def exists(file_name, coords):
+    """ Is there a room at coords in this level? """
+    return Level.get(file_name).has_room(*coords)
+
+  def __init__(self, file_name, coords):
+    level = Level.get(file_name)
+    if level.room_size != MAP_SIZE:
+      # Everything from the screen size to room scrolling assumes MAP_SIZE.
+      raise ValueError("%s has %d tile rooms, but the game needs %d." % (file_name, level.room_size, MAP_SIZE))
+
+    walls, tiles, spawns = level.room(*coords)
+    self.size = level.room_size
+
+    self.walls = walls # 1 for every wall tile, row by row. Shared, so don't write to it.
+    self.tiles = tuple(((i % self.size * TILE_SIZE, i // self.size * TILE_SIZE), tile)\
+                       for i, tile in enumerate(tiles))
+    self.spawns = tuple(spawns)
 
 class Map:
   Cache = {}
+  Spawned = set() # Rooms whose things have already been handed out.
 
   def in_bounds(self, x, y):
     return x >= 0 and y >= 0 and x < self.size and y < self.size
@@ -205,41 +461,43 @@ class Map:
 
   def is_wall(self, x, y):
     if not self.in_bounds(y, x): return False
-    return self.data[y][x] in WALLS
-
-  def parse(self, coords, rgb_triple):
-    if rgb_triple == (255, 0, 0): # Enemy
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    return self.walls[y * self.size + x] == 1
+
+  def box_hits_wall(self, x_abs, y_abs):
+    """ Is a tile-sized thing with its upper left corner at (x_abs, y_abs)
+    touching a wall? We give it 2 pixels of leeway on each side, which makes
+    it smaller than a tile, so the tiles under its corners are all the tiles
+    it could be touching. Nothing gets allocated. """
+    left = int((x_abs + 2) // TILE_SIZE)
+    right = int((x_abs + TILE_SIZE - 2) // TILE_SIZE)
+    top = int((y_abs + 2) // TILE_SIZE)
+    bottom = int((y_abs + TILE_SIZE - 2) // TILE_SIZE)
+
+    return self.is_wall(left, top) or self.is_wall(right, top) or\
+           self.is_wall(left, bottom) or self.is_wall(right, bottom)
+
+  def parse(self, coords, kind):
+    if kind == "enemy":
       Updater.add_updater(Enemy(coords, self.char, self))
-    if rgb_triple == (100, 0, 0): # Enemy In Reverse
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "enemy_reverse":
       Updater.add_updater(Enemy(coords, self.char, self)) #TODO?????????????
-    if rgb_triple == (0, 255, 0): # Rotator
-      self.current_map.set_at(coords, (255,255,255))
+    if kind == "rotator":
       Updater.add_updater(Rotator(coords))
-    if rgb_triple == (255, 255, 0): # Treasure
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "treasure":
       Updater.add_updater(Pickup(coords, "treasure", self.char))
-    if rgb_triple == (150,90,60): # Dialog
-      self.current_map.set_at(coords, NOTHING_COLOR)
-      Updater.add_updater(DialogStarter(coords, self.char, rgb_triple, self.map_coords, self))
-    if rgb_triple == (0,0,255): # Stairs
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "dialog":
+      Updater.add_updater(DialogStarter(coords, self.char, kind, self.map_coords, self))
+    if kind == "stairs":
       Updater.add_updater(Stairs(coords))
-    if rgb_triple == (200, 200, 0): # Replicator
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "replicator":
       Updater.add_updater(Pickup(coords, "replicator", self.char))
-    if rgb_triple == (200, 255, 0): # Enemy Escaper
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "escaper":
       Updater.add_updater(Pickup(coords, "escaper", self.char))
-    if rgb_triple == (150, 150, 150): # Signpost 1
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "signpost1":
       Updater.add_updater(Pickup(coords, "signpost1", self.char))
-    if rgb_triple == (151, 150, 150): # Signpost 2
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "signpost2":
       Updater.add_updater(Pickup(coords, "signpost2", self.char))
-    if rgb_triple == (200, 200, 200): # Big Bad Boss
-      self.current_map.set_at(coords, NOTHING_COLOR)
+    if kind == "boss":
       Updater.add_updater(Boss(coords, self.char, self, self.game))
 
   #got to update with abs
@@ -247,10 +505,10 @@ class Map:
     if x == 0 and y == 0 and not pos_abs: return # Don't bother.
 
     # Store stuff that stays between maps.
-    Map.Cache[tuple(self.map_coords)] = Updater.get_all(lambda x: hasattr(x, "cacheable"))
+    Map.Cache[tuple(self.map_coords)] = Updater.get_able("cacheable")
 
     # Remove old enemies
-    Updater.remove_all(lambda x: hasattr(x, "cacheable"))
+    Updater.remove_able("cacheable")
 
     if pos_abs:
       self.map_coords[0] = x
@@ -264,35 +522,53 @@ class Map:
       for item in Map.Cache[tuple(self.map_coords)]:
         Updater.add_updater(item)
 
-    self.current_map = TileSheet.get(self.file_name, *self.map_coords)
-
-    # This is like a preprocessor to parse things out of the map (like enemies)
-    [[self.parse((x, y), self.current_map.get_at((x, y))) for x in range(MAP_SIZE)]\
-                                                          for y in range(MAP_SIZE)]
-
-    self.data = [[self.current_map.get_at((x, y)) for x in range(MAP_SIZE)]\
-                                                  for y in range(MAP_SIZE)]
-
-    self.size = len(self.data)
-
-    self.mapdata = [[self.get_img(self.data[x][y])  for x in range(self.size)]\
-                                                    for y in range(self.size)]
-    self.maprects= [[self.mapdata[x][y].get_rect()  for x in range(self.size)]\
-                                                    for y in range(self.size)]
-    
-    for x in range(self.size):
-      for y in range(self.size):
-        self.maprects[x][y].x = x * TILE_SIZE
-        self.maprects[x][y].y = y * TILE_SIZE
-
+    self.room = Room.get(self.file_name, self.map_coords)
+    self.size = self.room.size
+    self.walls = self.room.walls
+
+    # Things in the map (like enemies) only get made the first time we're
+    # here. After that they come back out of Map.Cache.
+    if tuple(self.map_coords) not in Map.Spawned:
+      Map.Spawned.add(tuple(self.map_coords))
+      for coords, kind in self.room.spawns:
+        self.parse(coords, kind)
+
+    # Read the rooms next door ahead of time (see prefetch), so walking
+    # into them doesn't have to.
+    mx, my = self.map_coords
+    self.neighbours = [coords for coords in [(mx - 1, my), (mx + 1, my), (mx, my - 1), (mx, my + 1)]\
+                       if Room.exists(self.file_name, coords)]
+
+    # Rebaked lazily on the next render, so that the background parallax
+    # (which happens after we switch rooms) is picked up too.
+    self.layer = None
+    DirtyRects.invalidate()
+
+  def bake(self):
+    """Composite the background and all the static tiles of this room into a
+    single surface, so rendering the room is one blit instead of 400. With
+    NATIVE_SCALE that gets scaled up to the window once, here. """
+    layer = pygame.Surface((ABS_MAP_SIZE, ABS_MAP_SIZE)).convert()
+    background.render(layer)
+
+    # Straight out of the sheet, rather than through a subsurface per tile.
+    blits = []
+    for position, tile in self.room.tiles:
+      atlas, area = TileSheet.get_area("wall.png", *tile)
+      blits.append((atlas, position, area))
+    layer.blits(blits, False)
+
+    scale = draw_scale()
+    if scale != 1:
+      layer = pygame.transform.scale(layer, (ABS_MAP_SIZE * scale, ABS_MAP_SIZE * scale))
+    self.layer = layer
 
-  """Holds data related to the in-game map."""
-  def get_img(self, data_piece):
-    "Given some chunk of data, return the corresponding related image."
-    if data_piece == (255,255,255):
-      return TileSheet.get("wall.png", 0, 0)
-    elif data_piece == (0,0,0):
-      return TileSheet.get("wall.png", 1, 0)
+  def prefetch(self):
+    """ Read in one of the rooms next door, if there are any left. Called
+    every tick, so the work is spread out instead of landing on the tick we
+    change rooms. """
+    if self.neighbours:
+      Room.get(self.file_name, self.neighbours.pop())
 
   def __init__(self, file_name, coords, char, game):
     self.game = game
@@ -300,15 +576,18 @@ class Map:
     self.file_name = file_name
     self.map_coords = coords
 
-    TileSheet.add(file_name)
-
     self.update_map(*self.map_coords, pos_abs=True)
 
-  def render(self, screen):
-    """ Render the map """
-    for x in range(self.size):
-      for y in range(self.size):
-        screen.blit(self.mapdata[x][y], self.maprects[x][y])
+  def render(self, screen, rects=None):
+    """ Render the map (background included). If rects is given, only redraw
+    those parts of it. """
+    if self.layer is None:
+      self.bake()
+
+    if rects is None:
+      screen.blit(self.layer, (0, 0))
+    else:
+      screen.blits([(self.layer, rect, rect) for rect in rects], False)
   
 class Character:
   def __init__(self, x, y):
@@ -335,8 +614,8 @@ class Character:
       self.health = 3
     self.max_health = 3
 
-    self.img = TileSheet.get("wall.png", 0, 3)
-    self.rect = self.img.get_rect()
+    self.frame = (0, 3) # which tile in wall.png we look like right now
+    self.rect = TileSheet.get("wall.png", *self.frame).get_rect()
 
     self.ghost = Image("wall.png", 1, 1, 0, 0)
 
@@ -380,20 +659,20 @@ class Character:
 
   @staticmethod
   def touching_wall_only(x, y, game_map, uid=-1):
-    return or_fn([game_map.is_wall(*pos) for pos in get_touching(x, y)])
+    return game_map.box_hits_wall(x, y)
   
   # doesn't make sense for this to be a static method of character. Oh well.
   @staticmethod
   def touching_wall(x, y, game_map, uid=-1):
-    return or_fn([game_map.is_wall(*pos) for pos in get_touching(x, y)] + [Character.touching_updater(x, y, uid)])
+    return game_map.box_hits_wall(x, y) or Character.touching_updater(x, y, uid)
 
   @staticmethod
   def touching_updater(x, y, uid=-1):
-    return len([True for x in Updater.get_all(lambda obj: isinstance(obj, Replicated) and uid != obj.uid and generic_touching(obj, Point(x, y)))]) > 0
+    return len(Updater.get_near(x, y, lambda obj: isinstance(obj, Replicated) and uid != obj.uid and generic_touching(obj, Point(x, y)))) > 0
 
   @staticmethod
   def point_touching_updater(x, y, uid=-1):
-    return len([True for x in Updater.get_all(lambda obj: isinstance(obj, Replicated) and uid != obj.uid and point_touch_rect(Point(x, y), obj))]) > 0
+    return len(Updater.get_near(x, y, lambda obj: isinstance(obj, Replicated) and uid != obj.uid and point_touch_rect(Point(x, y), obj))) > 0
 
   @staticmethod
   def on_ground(x, y, game_map):
@@ -414,10 +693,13 @@ class Character:
       return #dead
 
     """ Move the character one tick. """
+    if self.flicker_tick > 0:
+      self.flicker_tick -= 1
+
     new_screen = False
     map_dx, map_dy = 0, 0
 
-    on_stairs = len(Updater.get_all(lambda obj: isinstance(obj, Stairs) and self.touching_item(obj))) > 0
+    on_stairs = len(Updater.get_near(self.x, self.y, lambda obj: isinstance(obj, Stairs) and self.touching_item(obj))) > 0
 
     if DEBUG:
       if keys[pygame.K_q]:
@@ -433,9 +715,9 @@ class Character:
       if self.vy != 0:
         self.anim_ticker += 1
         if self.anim_ticker / 5 % 2 == 0:
-          self.img = TileSheet.get("wall.png", 0, 4)
+          self.frame = (0, 4)
         else:
-          self.img = TileSheet.get("wall.png", 1, 4)
+          self.frame = (1, 4)
 
     jumping = False
 
@@ -452,9 +734,9 @@ class Character:
     if dx != 0:
       self.anim_ticker += 1
       if self.anim_ticker / 5 % 2 == 0:
-        self.img = TileSheet.get("wall.png", 0, 3)
+        self.frame = (0, 3)
       else:
-        self.img = TileSheet.get("wall.png", 1, 3)
+        self.frame = (1, 3)
 
       self.left_facing = (dx < 0)
 
@@ -469,28 +751,29 @@ class Character:
 
       new_screen = True
 
-    self.x += dx
-    while Character.touching_wall(self.x, self.y, game_map):
-      self.x += -sign(dx)
+    self.x = back_off(self.x + dx, self.y, -sign(dx), game_map)
 
-    for x in range(abs(dy)):
-      self.y += sign(dy)
-      if Character.touching_wall(self.x, self.y, game_map):
+    if dy != 0:
+      ranges = blocked_along_y(self.x, min(self.y + sign(dy), self.y + dy), max(self.y + sign(dy), self.y + dy), game_map)
+      steps = first_contact(self.y, dy, ranges)
+
+      if steps is None:
+        self.y += dy
+      else:
         if not self.on_ground:
           if not DEBUG:
             land_sound.play()
 
-        self.y -= sign(dy)
+        self.y += sign(dy) * (steps - 1)
         self.on_ground = True
         self.vy = 0
-        break
 
     if not Character.on_ground(self.x, self.y, game_map):
       self.on_ground = False
 
     if new_screen:
       background.parallax(map_dx, map_dy)
-      Updater.remove_all(lambda x: isinstance(x, Replicated))
+      Updater.remove_type(Replicated)
       self.set_restore_point()
 
     # Flip code <ESC>
@@ -578,28 +861,26 @@ class Character:
 
     game_map.update_map(self.res_death['mx'], self.res_death['my'], True)
 
-    Updater.remove_all(lambda x: isinstance(x, HoverText))
-    Updater.remove_all(lambda x: isinstance(x, Replicated))
-    Updater.remove_all(lambda x: isinstance(x, Boss))
+    Updater.remove_type(HoverText)
+    Updater.remove_type(Replicated)
+    Updater.remove_type(Boss)
 
   def set_restore_point(self):
     self.restore_x = self.x
     self.restore_y = self.y
 
+  def get_img(self):
+    """ What we look like right now, facing the right way. """
+    return TileSheet.get("wall.png", *self.frame, flip_x=not self.left_facing)
+
   def render(self, screen):
     self.rect.x = self.x
     self.rect.y = self.y
     
-    if self.flicker_tick > 0:
-      self.flicker_tick -= 1
-
-      if self.flicker_tick % 3 == 0:
-        return
+    if self.flicker_tick > 0 and self.flicker_tick % 3 == 0:
+      return
 
-    if self.left_facing:
-      screen.blit(self.img, self.rect)
-    else:
-      screen.blit(pygame.transform.flip(self.img, True, False), self.rect)
+    DirtyRects.blit(screen, self.get_img(), self.rect)
 
     if Updater.get_escape(self) is not None:
       self.ghost.render(screen)
@@ -623,6 +904,72 @@ class UpKeys:
       return True 
     return False
 
+class DirtyRects:
+  """ Remembers everything that was blitted onto the buffer this frame and
+  last frame. Anything that didn't move or change doesn't need to be presented
+  again, and the only parts of the map that need erasing are the ones
+  something was drawn over last frame.
+
+  It's also the render queue: blit() only writes the blit down, and flush()
+  draws everything written down so far in one Surface.blits call. Flush
+  before drawing on the screen any other way.
+
+  Positions are always in game pixels. With NATIVE_SCALE, blit() swaps in
+  the scaled up surface and position, so the rects in here are window
+  pixels. """
+  drawn = {} # (id(surface), rect) -> surface. Holding on to the surface keeps its id unique.
+  last_drawn = {}
+  full = True # Does the next frame have to be redrawn from scratch?
+  pending = [] # (surface, position) blits that haven't happened yet
+  pending_screen = None
+
+  @staticmethod
+  def invalidate():
+    DirtyRects.full = True
+
+  @staticmethod
+  def blit(screen, surf, dest):
+    if screen is not DirtyRects.pending_screen:
+      DirtyRects.flush()
+      DirtyRects.pending_screen = screen
+
+    # dest is often somebody's rect, which could move before we flush.
+    scale = draw_scale()
+    if scale != 1:
+      DirtyRects.pending.append((TileSheet.get_native(surf, scale), (int(dest[0]) * scale, int(dest[1]) * scale)))
+    else:
+      DirtyRects.pending.append((surf, (dest[0], dest[1])))
+
+  @staticmethod
+  def flush():
+    if not DirtyRects.pending: return
+
+    rects = DirtyRects.pending_screen.blits(DirtyRects.pending)
+    for (surf, dest), rect in zip(DirtyRects.pending, rects):
+      DirtyRects.drawn[(id(surf), tuple(rect))] = surf
+    DirtyRects.pending = []
+
+  @staticmethod
+  def begin_frame():
+    """ Returns True if this frame needs a full redraw. """
+    DirtyRects.last_drawn = DirtyRects.drawn
+    DirtyRects.drawn = {}
+
+    full = DirtyRects.full or not DIRTY_RECTS
+    DirtyRects.full = False
+    return full
+
+  @staticmethod
+  def erase_rects():
+    """ Everything that was drawn over last frame. """
+    return [pygame.Rect(key[1]) for key in DirtyRects.last_drawn]
+
+  @staticmethod
+  def changed_rects():
+    """ Everything that was drawn last frame but not this one or vice versa. """
+    keys = set(DirtyRects.drawn) ^ set(DirtyRects.last_drawn)
+    return [pygame.Rect(key[1]) for key in keys if key[1][2] > 0 and key[1][3] > 0]
+
 class Dialog:
   all_dialog = { (0, 0)    : [
                               ("Narrator", "You are the greatest escape artist. (Press X to continue)"),
@@ -687,12 +1034,13 @@ class Dialog:
     Dialog.game = game
 
   @staticmethod
-  def update(screen):
+  def update():
+    """ Returns False once the dialog is over. """
     if UpKeys.key_up(pygame.K_x):
       if not Dialog.next_dialog():
         return False
 
-    return Dialog.show_dialog(screen)
+    return True
 
   # All the True/Falses here are pure paranoia. Pretty sure they do nothing.
   @staticmethod
@@ -717,14 +1065,12 @@ class Dialog:
 
   @staticmethod
   def show_dialog(screen):
-    my_font = pygame.font.Font("freesansbold.ttf", 10)
-
     speaker, dialog = Dialog.all_dialog[Dialog.speaker][Dialog.position]
 
     my_rect = pygame.Rect((60, ABS_MAP_SIZE - 140, 300, 120))
-    rendered_text = render_textrect(dialog, my_font, my_rect, (10, 10, 10), (210, 255, 255), True, 0)
+    rendered_text = Text.render(dialog, "freesansbold.ttf", 10, my_rect, (10, 10, 10), (210, 255, 255), True, 0)
 
-    screen.blit(rendered_text, my_rect.topleft)
+    DirtyRects.blit(screen, rendered_text, my_rect.topleft)
     return True
 
 def cmp_eps(x, y):
@@ -781,41 +1127,90 @@ class DialogStarter:
     pass
 
 class ParticleGenerator:
-  def __init__(self, rate):
+  """ Makes particles at random spots in area, rate of them a tick on average
+  (rate can be less than 1), but never more than burst in one tick. """
+  def __init__(self, rate, area, lifespan=150, burst=3):
     self.rate = rate
+    self.area = pygame.Rect(area)
+    self.lifespan = lifespan
+    self.burst = burst
+    self.banked = 0.0
+
+  def update(self, particles):
+    self.banked = min(self.banked + self.rate, self.burst)
+    while self.banked >= 1:
+      self.banked -= 1
+      rng = particles.random
+      particles.add(self.area.x + rng.random() * self.area.w, self.area.y + rng.random() * self.area.h, self.lifespan)
+
+class Particles:
+  """ Every particle there is, kept in flat lists of floats instead of an
+  object (and an Image) each. The live ones are always the first count
+  entries, oldest first, which is also the order they're drawn in. The lists
+  are made once, so there are never more than size particles. """
+  def __init__(self, size, rng):
+    self.size = size
+    self.count = 0
+    self.random = rng # Separate from the game's, so particles don't change how the game plays out.
+    self.generators = []
+    self.sprite = TileSheet.get("particle.png", 0, 0)
+
+    # Plain lists rather than array("d"): CPython reads and writes list items
+    # faster, since it doesn't have to box a new float for every read.
+    self.fields = [[0.0] * size for i in range(6)]
+    self.x, self.y, self.base_x, self.speed, self.wobble_factor, self.age = self.fields
+    self.max_age = [1.0] * size
+    self.fields.append(self.max_age)
+
+  def add(self, x, y, lifespan):
+    """ Returns False if we're full. """
+    if self.count >= self.size: return False
+
+    i = self.count
+    self.x[i] = self.base_x[i] = x
+    self.y[i] = y
+    self.max_age[i] = lifespan
+    self.age[i] = lifespan * self.random.random() + 20
+    self.speed[i] = self.random.random()
+    self.wobble_factor[i] = self.random.random() * 10
+
+    self.count += 1
+    return True
 
   def update(self):
-    if random.random() < self.rate:
-      Updater.add_updater(Particle((100, 100), 150))
-
-class Particle:
-  def __init__(self, coords, lifespan):
-    self.coords = coords
-    self.x, self.y = coords
-
-    self.max_age = lifespan
-    self.sprite = Image("particle.png", 0, 0, self.x, self.y)
-    self.age = lifespan * random.random() + 20
-    self.speed = random.random() 
-
-    self.base_x = self.x
-    self.wobble_factor = random.random() * 10
-
-  def depth(self):
-    return 0
-
-  def update(self):
-    self.age -= 1
-    self.y -= self.speed
-    self.x = self.base_x + math.sin(float(self.age / 20)) * self.wobble_factor * float(self.max_age - self.age) / self.max_age
+    for generator in self.generators:
+      generator.update(self)
+
+    x, y, base_x, speed, wobble_factor, age, max_age = self.fields
+    sin = math.sin
+
+    # Slide the survivors down over the dead ones, keeping them in order.
+    # (Swapping the last one into the hole would be less copying, but then
+    # overlapping particles swap which one is on top, and DirtyRects doesn't
+    # know to redraw them.)
+    live = 0
+    for i in xrange(self.count):
+      a = age[i] - 1
+      if a <= 0: continue
+
+      if live != i:
+        for field in self.fields:
+          field[live] = field[i]
+      age[live] = a
+      y[live] -= speed[live]
+      x[live] = base_x[live] + sin(a / 20) * wobble_factor[live] * (max_age[live] - a) / max_age[live]
+      live += 1
+
+    self.count = live
 
     #TODO: Do something with alpha.
 
-    return self.age > 0
-
   def render(self, screen):
-    self.sprite.move(self.x, self.y)
-    self.sprite.render(screen)
+    """ Goes out with the rest of the sprites in DirtyRects' next blits. """
+    sprite = self.sprite
+    x, y = self.x, self.y
+    for i in xrange(self.count):
+      DirtyRects.blit(screen, sprite, (int(x[i]), int(y[i])))
 
 class Indicator:
   def __init__(self, char):
@@ -827,12 +1222,12 @@ class Indicator:
     return 20
 
   def update(self):
+    self.rotation += 2
     return True
 
   def render(self, screen):
     target = Updater.get_escape(self.char)
     if target is not None:
-      self.rotation += 2
       self.sprite.move(target.x, target.y)
       self.sprite.render(screen, 2, self.rotation)
 
@@ -939,26 +1334,34 @@ class Replicated:
     if self.vy < TILE_SIZE:
       self.vy += 1
 
-    for y in range(self.vy):
-      self.y += 1
-      if Character.touching_wall(self.x, self.y, self.game_map, self.uid) or generic_touching(self, self.char):
-        if generic_touching(self, self.char) and self.actually_bomb:
-          self.char.hurt(1, "enemy", self.game_map)
-          return False
+    ranges = blocked_along_y(self.x, self.y + 1, self.y + self.vy, self.game_map, self.uid)
+    char = self.char
+    if char.x - 16 <= self.x <= char.x + TILE_SIZE:
+      ranges.append((char.y - 16, char.y + TILE_SIZE))
+    steps = first_contact(self.y, self.vy, ranges)
 
-        self.y -= 1
-        self.vy = 0
-        if not self.on_ground:
-          if not DEBUG:
-            land_sound.play()
-        self.on_ground = True
-        break
-      else:
+    if steps is None:
+      self.y += self.vy
+      self.on_ground = False
+    else:
+      if steps > 1:
         self.on_ground = False
 
-    enemy_deaths = Updater.get_all(lambda obj: isinstance(obj, Enemy) and generic_touching(self, obj))
+      self.y += steps
+      if generic_touching(self, self.char) and self.actually_bomb:
+        self.char.hurt(1, "enemy", self.game_map)
+        return False
+
+      self.y -= 1
+      self.vy = 0
+      if not self.on_ground:
+        if not DEBUG:
+          land_sound.play()
+      self.on_ground = True
+
+    enemy_deaths = Updater.get_near(self.x, self.y, lambda obj: isinstance(obj, Enemy) and generic_touching(self, obj))
     boss_hits = []
-    boss_hits = Updater.get_all(lambda obj: isinstance(obj, Boss) and generic_touching(self, obj))
+    boss_hits = Updater.get_near(self.x, self.y, lambda obj: isinstance(obj, Boss) and generic_touching(self, obj))
 
 
     for enemy in enemy_deaths:
@@ -1020,6 +1423,7 @@ class Boss:
     new_coords = [coords[0] * TILE_SIZE, coords[1] * TILE_SIZE]
     self.x = new_coords[0]
     self.y = new_coords[1]
+    self.size = 2 * TILE_SIZE
     
     self.sprite = Image("wall.png", 3, 4, self.x, self.y)
 
@@ -1121,6 +1525,8 @@ class Enemy:
 
     self.sprite = Image("wall.png", 0, 1, *new_coords)
     self.los = [Image("wall.png", 3, 1, *(0, 0)) for x in range(self.los_dist)]
+    self.seen_walls = {} # (tiles we're over, way we're facing) -> which squares in front are in a wall
+    self.sight = 0 # how many of los we can actually see
     self.ticks = 0
 
     # Could have many destinations
@@ -1128,6 +1534,8 @@ class Enemy:
     self.x = new_coords[0]
     self.y = new_coords[1]
 
+    self.look()
+
   def damage(self, amount):
     self.health -= amount
 
@@ -1154,7 +1562,7 @@ class Enemy:
       return self.flicker_ticker > 0
 
     # TODO: Include this object too, not just its sight range
-    for eyesight in (self.los + [self]):
+    for eyesight in (self.los[:self.sight] + [self]):
       if self.char.touching_item(eyesight):
         if self.char.hurt(1, "enemy", self.game_map):
           return True
@@ -1179,23 +1587,48 @@ class Enemy:
       self.move_dir.y += sign(goal.y - self.move_dir.y) * float(.1)
 
     self.sprite.move(self.x, self.y)
+    self.look()
     return True
 
+  def look(self):
+    """ Put the line of sight squares in front of us, up to the first one
+    that's in a wall or one of your dead bodies. Walls don't move, so when
+    we're facing straight along an axis which squares they hide only gets
+    worked out again when we get over a new tile or turn around. Bodies can
+    land anywhere, so they're checked every time. """
+    x, y = int(self.x), int(self.y)
+
+    if self.move_dir.is_simple():
+      facing = (int(round(self.move_dir.x)), int(round(self.move_dir.y)))
+      squares = [(x + TILE_SIZE * l_dist * facing[0], y + TILE_SIZE * l_dist * facing[1])\
+                 for l_dist in range(1, self.los_dist + 1)] #+ 1 so that we don't overlap with self
+
+      # The tiles under the corners are all box_hits_wall looks at, and
+      # they're the same for every square, just shifted over.
+      key = ((x + 2) // TILE_SIZE, (x + TILE_SIZE - 2) // TILE_SIZE,\
+             (y + 2) // TILE_SIZE, (y + TILE_SIZE - 2) // TILE_SIZE, facing)
+      if key not in self.seen_walls:
+        self.seen_walls[key] = [self.game_map.box_hits_wall(*square) for square in squares]
+      walls = self.seen_walls[key]
+    else:
+      # Turning around; this is just for show until we're done.
+      squares = [(int(self.x + TILE_SIZE * l_dist * self.move_dir.x), int(self.y + TILE_SIZE * l_dist * self.move_dir.y))\
+                 for l_dist in range(1, self.los_dist + 1)]
+      walls = [self.game_map.box_hits_wall(*square) for square in squares]
+
+    self.sight = 0
+    for square, wall in zip(squares, walls):
+      if wall or Character.touching_updater(*square):
+        break
+      self.los[self.sight].move(*square)
+      self.sight += 1
+
   def render(self, screen):
     if self.visible:
       self.sprite.render(screen)
 
-      hide_rest = False
-      for l_dist in range(1, self.los_dist + 1): #+ 1 so that we don't overlap with self
-        self.los[l_dist - 1].move(self.x + TILE_SIZE * l_dist * self.move_dir.x, self.y + TILE_SIZE * l_dist * self.move_dir.y)
-
-        if Character.touching_wall(self.los[l_dist - 1].x, self.los[l_dist - 1].y, self.game_map):
-          hide_rest = True
-
-        if hide_rest:
-          self.los[l_dist - 1].move(-500,-500)
-
-        self.los[l_dist - 1].render(screen)
+      for eyesight in self.los[:self.sight]:
+        eyesight.render(screen)
 
 class HoverText:
   # follow must expose x, y (could generalize to enemies etc)
@@ -1215,14 +1648,12 @@ class HoverText:
   def render(self, screen):
     my_width = 100
 
-    my_font = pygame.font.Font("freesansbold.ttf", 10)
-
     my_rect = pygame.Rect((self.follow.x - my_width / 2, self.follow.y - len(self.text) - 30, my_width, 70))
     if my_rect.x < 0:
       my_rect.x = 0
-    rendered_text = render_textrect(self.text, my_font, my_rect, (10, 10, 10), (255, 255, 255), False, 1)
+    rendered_text = Text.render(self.text, "freesansbold.ttf", 10, my_rect, (10, 10, 10), (255, 255, 255), False, 1)
 
-    screen.blit(rendered_text, my_rect.topleft)
+    DirtyRects.blit(screen, rendered_text, my_rect.topleft)
 
 class HUD:
   def __init__(self, follow):
@@ -1253,49 +1684,212 @@ class HUD:
     [heart.render(screen) for heart in self.hearts]
     [treasure.render(screen) for treasure in self.treasures]
 
+class SpatialHash:
+  """ Buckets things by which tiles they cover, so "what's around here?"
+  only has to look at the handful of things that are actually nearby. Anything
+  with an x and y can go in; things bigger than a tile should have a size. """
+  def __init__(self, cell_size):
+    self.cell_size = cell_size
+    self.cells = {} # (cell x, cell y) -> things in that cell
+    self.placed = {} # id(thing) -> (left, top, right, bottom) cells it's in
+
+  def bounds(self, x, y, w, h):
+    size = self.cell_size
+    return (int(x // size), int(y // size), int((x + w) // size), int((y + h) // size))
+
+  def bounds_of(self, thing):
+    size = getattr(thing, "size", TILE_SIZE)
+    return self.bounds(thing.x, thing.y, size, size)
+
+  def insert(self, thing):
+    bounds = self.bounds_of(thing)
+    self.placed[id(thing)] = bounds
+
+    left, top, right, bottom = bounds
+    for x in range(left, right + 1):
+      for y in range(top, bottom + 1):
+        self.cells.setdefault((x, y), []).append(thing)
+
+  def remove(self, thing):
+    bounds = self.placed.pop(id(thing), None)
+    if bounds is None: return
+
+    left, top, right, bottom = bounds
+    for x in range(left, right + 1):
+      for y in range(top, bottom + 1):
+        cell = self.cells[(x, y)]
+        cell.remove(thing)
+        if not cell:
+          del self.cells[(x, y)]
+
+  def move(self, thing):
+    """ Call whenever thing might have moved. Cheap if it stayed in its cells. """
+    if self.placed.get(id(thing)) != self.bounds_of(thing):
+      self.remove(thing)
+      self.insert(thing)
+
+  def query(self, x, y, w, h):
+    """ Everything in the cells the box touches. Might include things that
+    don't actually overlap it. """
+    result = []
+    seen = set()
+
+    left, top, right, bottom = self.bounds(x, y, w, h)
+    for cx in range(left, right + 1):
+      for cy in range(top, bottom + 1):
+        for thing in self.cells.get((cx, cy), ()):
+          if id(thing) not in seen:
+            seen.add(id(thing))
+            result.append(thing)
+
+    return result
+
 class Updater:
   # Update each item every step (until it kills itself)
 
   # Must expose 3 mthods
-  # depth(): returns relative depth or 0 if it doesn't matter
+  # depth(): returns relative depth or 0 if it doesn't matter. Only asked once,
+  #          when the item is added, so it can't change.
   # update(): returns False if destroyed, True otherwise
   # render(screen): renders the object
-  items = [] # Things that need to be updated every step
+  # Items keep the slot they were added in, so taking one out is just
+  # putting a None there. The Nones get squeezed out (see compact) once
+  # they're half of the list; new items always go on the end, so the update
+  # order is always the order things were added in.
+  items = [] # Things that need to be updated every step, and None for the removed ones
+  slots = {} # id(item) -> where it is in items
+  holes = 0 # how many Nones are in items
+  updating = False # in the middle of update_all, so slots can't move
+  grid = SpatialHash(TILE_SIZE) # Everything in items that has a position
   KillAll = "killall"
 
+  # The same items again, bucketed (in the same order as items) so asking for
+  # one kind of thing doesn't mean looking at everything. Removed items leave
+  # a None in their buckets too, and compact squeezes those out as well.
+  Abilities = ["escape", "cacheable"]
+  by_type = {} # class -> items of exactly that class
+  by_ability = dict((ability, []) for ability in Abilities) # method name -> items that have it
+  by_depth = {} # depth -> items at that depth
+  depths = [] # every depth in by_depth, back to front
+  places = {} # id(item) -> [(bucket, where it is in bucket), ...]
+
   @staticmethod
   def add_updater(updater):
+    Updater.slots[id(updater)] = len(Updater.items)
     Updater.items.append(updater)
 
+    buckets = [Updater.by_type.setdefault(updater.__class__, [])]
+    for ability in Updater.Abilities:
+      if hasattr(updater, ability):
+        buckets.append(Updater.by_ability[ability])
+
+    depth = updater.depth()
+    if depth not in Updater.by_depth:
+      Updater.by_depth[depth] = []
+      bisect.insort(Updater.depths, depth)
+    buckets.append(Updater.by_depth[depth])
+
+    places = []
+    for bucket in buckets:
+      places.append((bucket, len(bucket)))
+      bucket.append(updater)
+    Updater.places[id(updater)] = places
+
+    if hasattr(updater, "x"):
+      Updater.grid.insert(updater)
+
   @staticmethod
   def update_all():
-    Updater.items = [item for item in Updater.items if item.update()]
-
-    # This is a really hard problem. Think about it after LD.
+    dead = []
     kills = []
-    for item in Updater.items:
-      if hasattr(item, 'kill_lambda'):
-        kills.append(item.kill_lambda)
 
-    for kill_lambda in kills:
-      Updater.items = [item for item in Updater.items if not kill_lambda(item)]
+    # Things added while we're going get updated this tick too.
+    Updater.updating = True
+    items = Updater.items
+    slot = 0
+    while slot < len(items):
+      item = items[slot]
+      slot += 1
+      if item is None: continue
+
+      keep = item.update()
+      if hasattr(item, "x"):
+        Updater.grid.move(item)
+
+      if keep:
+        # This is a really hard problem. Think about it after LD.
+        if hasattr(item, 'kill_lambda'):
+          kills.append(item.kill_lambda)
+      else:
+        dead.append(item) # Still there as far as everyone else is concerned this tick.
+    Updater.updating = False
+
+    Updater.remove(dead)
+
+    # Everything any of the kill lambdas wants gone, in one go.
+    if kills:
+      Updater.remove_all(lambda item: any(kill_lambda(item) for kill_lambda in kills))
 
   @staticmethod
-  def render_all(screen):
-    # sort by depth
-    items_sorted = sorted(Updater.items, key=lambda x:x.depth())
+  def remove(doomed):
+    """ Get rid of every item in doomed. """
+    if not doomed: return
 
-    for item in items_sorted:
-      item.render(screen)
+    removed = []
+    for item in doomed:
+      slot = Updater.slots.pop(id(item), None)
+      if slot is None: continue # not in here (any more)
+
+      Updater.items[slot] = None
+      removed.append(item)
+
+    Updater.holes += len(removed)
+    Updater.unindex(removed)
+    Updater.compact()
+
+  @staticmethod
+  def compact():
+    """ Squeeze the Nones out of items, if there are enough of them to be
+    worth it and nobody's walking through items right now. """
+    if Updater.updating or Updater.holes * 2 < len(Updater.items): return
+
+    Updater.items = [item for item in Updater.items if item is not None]
+    Updater.slots = dict((id(item), slot) for slot, item in enumerate(Updater.items))
+    Updater.holes = 0
+
+    # Every removed item left one None per bucket it was in, so the buckets
+    # are never holding more Nones than items was.
+    Updater.places = {}
+    for buckets in [Updater.by_type, Updater.by_ability, Updater.by_depth]:
+      for bucket in buckets.values():
+        bucket[:] = [item for item in bucket if item is not None]
+        for where, item in enumerate(bucket):
+          Updater.places.setdefault(id(item), []).append((bucket, where))
+
+  @staticmethod
+  def unindex(doomed):
+    """ Take every item in doomed out of the buckets and the grid. """
+    for item in doomed:
+      for bucket, where in Updater.places.pop(id(item)):
+        bucket[where] = None
+      Updater.grid.remove(item)
+
+  @staticmethod
+  def render_all(screen):
+    # back to front, and in the order they were added within a depth
+    for depth in Updater.depths:
+      for item in Updater.by_depth[depth]:
+        if item is not None:
+          item.render(screen)
+      DirtyRects.flush()
 
   @staticmethod
   def get_escape(char):
     targets = []
 
-    for item in Updater.items:
-      if hasattr(item, 'escape'):
-        if item.escape():
-          targets.append(item)
+    for item in Updater.by_ability["escape"]:
+      if item is not None and item.escape():
+        targets.append(item)
     
     if len(targets) == 0: return None
 
@@ -1305,11 +1899,202 @@ class Updater:
 
   @staticmethod
   def remove_all(fn):
-    Updater.items = [item for item in Updater.items if not fn(item)]
+    Updater.remove([item for item in Updater.items if item is not None and fn(item)])
+
+  @staticmethod
+  def remove_type(cls):
+    Updater.remove(Updater.get_type(cls))
+
+  @staticmethod
+  def remove_able(ability):
+    Updater.remove(Updater.get_able(ability))
 
   @staticmethod
   def get_all(fn):
-    return [item for item in Updater.items if fn(item)]
+    return [item for item in Updater.items if item is not None and fn(item)]
+
+  @staticmethod
+  def get_type(cls):
+    """ Every item of exactly class cls. """
+    return [item for item in Updater.by_type.get(cls, []) if item is not None]
+
+  @staticmethod
+  def get_able(ability):
+    """ Every item with a method called ability (one of Abilities). """
+    return [item for item in Updater.by_ability[ability] if item is not None]
+
+  @staticmethod
+  def get_near(x, y, fn):
+    """ Like get_all, but only looks at things with a position that are
+    within a tile of the tile-sized box at (x, y). """
+    return [item for item in Updater.grid.query(x - TILE_SIZE, y - TILE_SIZE, 3 * TILE_SIZE, 3 * TILE_SIZE) if fn(item)]
+
+class Compositor:
+  """ Covers whole surfaces with a color: clears, fades and tints. The overlays
+  it blends with are made once per size and color and then reused, instead
+  of allocating a new screen-sized surface every frame. Singleton like
+  TileSheet. """
+  overlays = {}
+
+  @staticmethod
+  def clear(screen, color=(0, 0, 0)):
+    screen.fill(color)
+
+  @staticmethod
+  def fade(screen, alpha, color=(0, 0, 0)):
+    """ Cover screen with color, alpha of the way (out of 255). """
+    key = (screen.get_size(), color)
+    if key not in Compositor.overlays:
+      overlay = pygame.Surface(screen.get_size(), 0, screen)
+      overlay.fill(color)
+      Compositor.overlays[key] = overlay
+
+    overlay = Compositor.overlays[key]
+    overlay.set_alpha(alpha)
+    screen.blit(overlay, (0, 0))
+
+class Blur:
+  """ The Blurry state's effect. Nothing moves while it's on, so rather than
+  blurring every frame we freeze the first one and blur that once for each
+  amount the effect goes through. The surfaces it works in are kept around
+  for next time. """
+  def __init__(self):
+    self.frozen = None
+    self.freeze = True
+    self.levels = {} # amount -> the frozen frame blurred that much
+    self.small = {} # amount -> where that blur gets shrunk down to
+    self.ready = set() # amounts blurred from the current frozen frame
+
+  def start(self):
+    """ The next frame rendered gets frozen. """
+    self.ready = set()
+    self.freeze = True
+
+  def render(self, screen, amt):
+    """ Blur screen (which should be the whole frame) by amt. """
+    if self.frozen is None or self.frozen.get_size() != screen.get_size():
+      self.frozen = screen.copy()
+      self.levels = {}
+      self.small = {}
+      self.ready = set()
+    elif self.freeze:
+      self.frozen.blit(screen, (0, 0))
+    self.freeze = False
+
+    if amt not in self.ready:
+      if amt not in self.levels:
+        self.levels[amt] = self.frozen.copy()
+        self.small[amt] = pygame.Surface(blur_scale(self.frozen, amt), 0, self.frozen)
+      blur_surf(self.frozen, amt, self.small[amt], self.levels[amt])
+      self.ready.add(amt)
+
+    screen.blit(self.levels[amt], (0, 0))
+
+class FrameClock:
+  """ Paces the main loop. Real time is banked and spent in fixed size
+  simulation steps, so the game runs at the same speed however long drawing
+  takes. If we fall too far behind we only catch up max_skip ticks and drop the
+  rest rather than spiralling. Drawing can be capped at its own rate. """
+  def __init__(self, tick_rate, max_skip, render_rate=None):
+    self.step = 1.0 / tick_rate
+    self.max_skip = max_skip
+    if render_rate:
+      self.draw_step = 1.0 / render_rate
+    else:
+      self.draw_step = 0
+
+    self.last = time.time()
+    self.banked = 0.0
+    self.next_draw = self.last
+    self.undrawn = False # Have we ticked since we last drew?
+
+    # Stats, refreshed every second.
+    self.tps = 0.0
+    self.fps = 0.0
+    self.jitter = 0.0 # standard deviation of frame times, in seconds
+    self.stats_start = self.last
+    self.stats_ticks = 0
+    self.last_frame = self.last
+    self.frame_times = []
+
+    # Totals over the whole run.
+    self.start = self.last
+    self.total_ticks = 0
+    self.total_frames = 0
+    self.total_frame_time = 0.0
+    self.total_frame_time_sq = 0.0
+
+  def ticks_due(self):
+    """ How many ticks should we run right now? """
+    now = time.time()
+    self.banked += now - self.last
+    self.last = now
+
+    due = int(self.banked / self.step)
+    if due > self.max_skip:
+      due = self.max_skip
+      self.banked = 0.0
+    else:
+      self.banked -= due * self.step
+    return due
+
+  def ticked(self):
+    self.stats_ticks += 1
+    self.total_ticks += 1
+    self.undrawn = True
+
+  def should_draw(self):
+    if not self.undrawn: return False
+
+    now = time.time()
+    if now < self.next_draw: return False
+
+    self.next_draw = now + self.draw_step
+    return True
+
+  def drew(self):
+    """ Call after each frame. Returns True if the stats were refreshed. """
+    now = time.time()
+    self.undrawn = False
+    frame_time = now - self.last_frame
+    self.frame_times.append(frame_time)
+    self.last_frame = now
+
+    self.total_frames += 1
+    self.total_frame_time += frame_time
+    self.total_frame_time_sq += frame_time ** 2
+
+    elapsed = now - self.stats_start
+    if elapsed < 1: return False
+
+    mean = sum(self.frame_times) / len(self.frame_times)
+    self.tps = self.stats_ticks / elapsed
+    self.fps = len(self.frame_times) / elapsed
+    self.jitter = math.sqrt(sum((t - mean) ** 2 for t in self.frame_times) / len(self.frame_times))
+
+    self.stats_start = now
+    self.stats_ticks = 0
+    self.frame_times = []
+    return True
+
+  def report(self):
+    return "%.1f ticks/sec, %.1f fps, jitter %.1fms" % (self.tps, self.fps, self.jitter * 1000)
+
+  def summary(self):
+    """ Same as report(), but over the whole run. """
+    elapsed = max(time.time() - self.start, .000001)
+    frames = max(self.total_frames, 1)
+    mean = self.total_frame_time / frames
+    jitter = math.sqrt(max(self.total_frame_time_sq / frames - mean ** 2, 0))
+
+    return "%d ticks, %d frames in %.2fs: %.1f ticks/sec, mean frame %.2fms, jitter %.2fms" %\
+        (self.total_ticks, self.total_frames, elapsed, self.total_ticks / elapsed, mean * 1000, jitter * 1000)
+
+  def wait(self):
+    """ Sleep until the next tick is due. """
+    delay = self.step - self.banked - (time.time() - self.last)
+    if delay > 0:
+      time.sleep(delay)
 
 class States:
   Dialog = "Dialog"
@@ -1319,29 +2104,57 @@ class States:
   GameOver = "GameOver"
 
 class Game:
-  def __init__(self):
+  def __init__(self, headless=False, seed=None, record=None, replay=None):
+    """ headless: no window, no sound, and nothing waits on the real clock.
+    seed: seed for everything random in the game, to make runs repeatable.
+    record: file to record every tick's input to.
+    replay: file to take input from instead of the keyboard. Its seed wins. """
     self.keys_up = []
+    self.headless = headless
+    self.timings = None # Set to a dict to total up where tick time goes.
+
+    self.replay = None
+    if replay is not None:
+      self.replay = InputReplay(replay)
+      seed = self.replay.seed
+
+    self.recorder = None
+    if record is not None:
+      if seed is None:
+        seed = int(time.time())
+      # Replays only have room for 32 bits of seed, so fold anything else
+      # (negative, huge) into that before we use it for anything.
+      seed &= 0xFFFFFFFF
+      self.recorder = InputRecorder(record, seed)
+
+    if seed is not None:
+      random.seed(seed)
+
+    if headless:
+      os.environ["SDL_VIDEODRIVER"] = "dummy"
 
     pygame.display.init()
     pygame.font.init()
     pygame.font.init()
 
-    if not DEBUG:
+    global land_sound, escape_sound, get_sound
+    if headless:
+      land_sound = escape_sound = get_sound = NullSound()
+    elif not DEBUG:
       pygame.mixer.init(frequency=22050, size=-16, channels=2, buffer=1024)
       pygame.mixer.music.load('ludumherp.mp3')
       pygame.mixer.music.play(-1) #Infinite loop! HAHAH!
 
-      global land_sound
       land_sound = pygame.mixer.Sound("land.wav")
 
-      global escape_sound
       escape_sound = pygame.mixer.Sound("escape.wav")
 
-      global get_sound
       get_sound = pygame.mixer.Sound("getstuff.wav")
 
     self.screen = pygame.display.set_mode((ABS_MAP_SIZE * 2, ABS_MAP_SIZE * 2))
     self.buff = pygame.Surface((ABS_MAP_SIZE, ABS_MAP_SIZE))
+    self.output = None
+    self.blur = Blur()
 
 
     global background
@@ -1357,25 +2170,75 @@ class Game:
     Dialog.begin(self)
 
     if DEBUG:
-      self.map = Map("map.png", [2, 3], self.char, self)
+      self.map = Map("map.lvl", [2, 3], self.char, self)
       self.state = States.Normal
     else:
-      self.map = Map("map.png", [0, 0], self.char, self)
+      self.map = Map("map.lvl", [0, 0], self.char, self)
       self.state = States.Dialog
       Dialog.start_dialog((0, 0))
 
     self.char.set_death_point(self.map)
 
-    # self.partgen = ParticleGenerator(.4)
+    self.particles = Particles(MAX_PARTICLES, random.Random(seed))
+    if PARTICLES:
+      self.particles.generators.append(ParticleGenerator(.4, (0, 0, ABS_MAP_SIZE, ABS_MAP_SIZE)))
+
     Updater.add_updater(HUD(self.char))
 
     # Add indicator
     Updater.add_updater(Indicator(self.char))
 
+    self.clock = FrameClock(TICK_RATE, MAX_FRAME_SKIP, RENDER_RATE)
+
+  def get_output(self):
+    """ The part of the screen the buffer gets scaled up onto. We scale
+    straight into it rather than into a new surface that then gets copied
+    over. Remade when GAME_SIZE changes. """
+    size = (ABS_MAP_SIZE * GAME_SIZE, ABS_MAP_SIZE * GAME_SIZE)
+    if self.output is None or self.output.get_size() != size:
+      self.output = self.screen.subsurface(pygame.Rect((0, 0), size))
+    return self.output
+
+  def get_canvas(self):
+    """ What the frame gets drawn on: the buffer, or with NATIVE_SCALE the
+    screen itself. """
+    if NATIVE_SCALE:
+      return self.get_output()
+    return self.buff
+
+  def present(self, full):
+    """ Scale the buffer up onto the screen and show it. """
+    if NATIVE_SCALE:
+      # It's already there.
+      if full:
+        pygame.display.flip()
+      else:
+        pygame.display.update(DirtyRects.changed_rects())
+      return
+
+    output = self.get_output()
+
+    if full:
+      if output.get_size() != self.screen.get_size():
+        Compositor.clear(self.screen)
+
+      pygame.transform.scale(self.buff, output.get_size(), output)
+      pygame.display.flip()
+      return
+
+    updated = []
+    for rect in DirtyRects.changed_rects():
+      dest = pygame.Rect(rect.x * GAME_SIZE, rect.y * GAME_SIZE, rect.w * GAME_SIZE, rect.h * GAME_SIZE)
+      pygame.transform.scale(self.buff.subsurface(rect), dest.size, output.subsurface(dest))
+      updated.append(dest)
+
+    pygame.display.update(updated)
+
   def set_state(self, state):
     if state == States.Blurry:
       self.blurriness = 1
       self.dblurry = 2
+      self.blur.start()
 
     if state == States.Death:
       self.death = 230
@@ -1385,96 +2248,213 @@ class Game:
       self.finished_time = time.time()
 
     self.state = state
-
-  def loop(self):
-    # self.set_state(States.GameOver)
-
-    while 1:
-      for event in pygame.event.get():
-        if event.type == pygame.QUIT: 
-          pygame.display.quit()
-          exit(0)
-        if event.type == pygame.KEYUP:
-          UpKeys.add_key(event.key)
-
-      global background
-      background.render(self.buff)
-      self.map.render(self.buff)
-
-      global GAME_SIZE
-      if UpKeys.key_up(pygame.K_s):
-        if GAME_SIZE == 2:
-          GAME_SIZE = 1
-        else: 
-          GAME_SIZE = 2
-
-      if self.state == States.Dialog:
-        Updater.render_all(self.buff)
-        self.char.render(self.buff)
-        if not Dialog.update(self.buff):
-          self.state = States.Normal
-      elif self.state == States.Normal:
-        # self.partgen.update()
+    DirtyRects.invalidate()
+
+  def tick(self, keys):
+    """ Advance the game by exactly one simulation step. """
+    global GAME_SIZE
+    if UpKeys.key_up(pygame.K_s):
+      if GAME_SIZE == 2:
+        GAME_SIZE = 1
+      else: 
+        GAME_SIZE = 2
+      self.map.layer = None # Rebaked at the new size.
+      DirtyRects.invalidate()
+
+    self.map.prefetch()
+
+    if self.state == States.Dialog:
+      if not Dialog.update():
+        self.state = States.Normal
+    elif self.state == States.Normal:
+      self.particles.update()
+      if self.timings is None:
+        Updater.update_all()
+        self.char.update(keys, self.map, self)
+      else:
+        start = time.time()
         Updater.update_all()
-        Updater.render_all(self.buff)
-        self.char.render(self.buff)
-        self.char.update(pygame.key.get_pressed(), self.map, self)
-      elif self.state == States.Blurry:
-        Updater.render_all(self.buff)
-        self.char.render(self.buff)
+        middle = time.time()
+        self.char.update(keys, self.map, self)
+        self.timings["Updater.update_all"] += middle - start
+        self.timings["Character.update"] += time.time() - middle
+    elif self.state == States.Blurry:
+      self.blurriness += self.dblurry
+      if self.blurriness >= 10:
+        self.dblurry *= -1
+      if self.blurriness <= 0:
+        self.dblurry = 0
+        self.set_state(States.Normal)
+    elif self.state == States.Death:
+      self.death += self.ddeath
+      if self.death >= 240:
+        self.ddeath *= -1
+      if self.death <= 0:
+        self.ddeath = 0
+        self.set_state(States.Normal)
+
+  def draw(self):
+    """ Render the current state of the game and put it on the screen. """
+    canvas = self.get_canvas()
+    full_redraw = DirtyRects.begin_frame()
+    if full_redraw:
+      if NATIVE_SCALE and canvas.get_size() != self.screen.get_size():
+        Compositor.clear(self.screen)
+      self.map.render(canvas)
+    else:
+      self.map.render(canvas, DirtyRects.erase_rects())
+
+    if self.state != States.GameOver:
+      self.particles.render(canvas)
+      Updater.render_all(canvas)
+      self.char.render(canvas)
+      DirtyRects.flush()
+
+    if self.state == States.Dialog:
+      Dialog.show_dialog(canvas)
+      DirtyRects.flush()
+    elif self.state == States.Blurry:
+      # Blurrier at bigger sizes, so it looks the same.
+      self.blur.render(canvas, self.blurriness * draw_scale())
+      DirtyRects.invalidate()
+    elif self.state == States.Death:
+      Compositor.fade(canvas, self.death)
+      DirtyRects.invalidate()
+    elif self.state == States.GameOver:
+      elapsed = "%d minutes, %d seconds." % (int((self.finished_time - START_TIME)/60), int(self.finished_time - START_TIME) % 60)
+      gameover = """
+      Hooray! You win!
+
+      Afterwards:
+
+      Even though you beat their boss, killed all their personel, and stole their gold, MegaCorp has come to the conclusion that you must be dead, because they found thousands of your dead bodies littering their dungeons. 
+
+      Not a bad way for things to end up.
+
+      elapsed time: %s
+
+      deaths: %d
+
+      percentage complete (gold): %d%%""" % (elapsed, DEATH_COUNT, int(100 * self.char.gold / 7))
+
+      # The text fills the whole frame.
+      my_rect = pygame.Rect(0, 0, ABS_MAP_SIZE, ABS_MAP_SIZE)
+      DirtyRects.blit(canvas, Text.render(gameover, "freesansbold.ttf", 10, my_rect, (10, 10, 10), (210, 255, 255), True, 0), (0, 0))
+      DirtyRects.flush()
+      DirtyRects.invalidate()
+
+    # Room transitions and the fancy effects invalidate the whole frame.
+    self.present(full_redraw or DirtyRects.full)
+
+  def read_input(self):
+    """ Returns the keys held for the coming tick, and makes sure UpKeys holds
+    the keys released for it. Comes from the replay if we have one. """
+    if self.replay is not None:
+      keys, UpKeys.keys = self.replay.next()
+    elif self.headless:
+      # Nobody is there to read the dialogs.
+      keys = NoKeys()
+      if self.state == States.Dialog:
+        UpKeys.add_key(pygame.K_x)
+    else:
+      keys = pygame.key.get_pressed()
 
-        self.buff = blur_surf(self.buff, self.blurriness)
-        self.blurriness += self.dblurry
-        if self.blurriness >= 10:
-          self.dblurry *= -1
-        if self.blurriness <= 0:
-          self.dblurry = 0
-          self.set_state(States.Normal)
-      elif self.state == States.Death:
-        Updater.render_all(self.buff)
-        self.char.render(self.buff)
+    if self.recorder is not None:
+      self.recorder.record(keys, UpKeys.keys)
 
-        blackness = pygame.Surface((ABS_MAP_SIZE * 2, ABS_MAP_SIZE * 2))
-        blackness.set_alpha(self.death)
-        self.buff.blit(blackness, blackness.get_rect())
+    return keys
 
-        self.death += self.ddeath
-        if self.death >= 240:
-          self.ddeath *= -1
-        if self.death <= 0:
-          self.ddeath = 0
-          self.set_state(States.Normal)
-      elif self.state == States.GameOver:
+  def digest(self):
+    """ Fingerprint of the game state, to check two runs ended up the same. """
+    char = self.char
+    state = [self.state, tuple(self.map.map_coords), DEATH_COUNT,
+             char.x, char.y, char.vx, char.vy, char.health, tuple(char.items)]
+    for item in Updater.items:
+      if item is None: continue
+      state.append((item.__class__.__name__, getattr(item, "x", None), getattr(item, "y", None)))
 
-        my_font = pygame.font.Font("freesansbold.ttf", 10)
-        elapsed = "%d minutes, %d seconds." % (int((self.finished_time - START_TIME)/60), int(self.finished_time - START_TIME) % 60)
-        gameover = """
-        Hooray! You win!
+    return hashlib.md5(repr(state)).hexdigest()
 
-        Afterwards:
+  def finish(self):
+    """ Wrap up a run. Returns a little report on it. """
+    if self.recorder is not None:
+      self.recorder.close()
+      self.recorder = None
 
-        Even though you beat their boss, killed all their personel, and stole their gold, MegaCorp has come to the conclusion that you must be dead, because they found thousands of your dead bodies littering their dungeons. 
+    return "%s\nfinal state: %s" % (self.clock.summary(), self.digest())
 
-        Not a bad way for things to end up.
+  def run_headless(self, ticks=None, draw=False):
+    """ Run ticks as fast as the CPU allows (the whole replay if ticks is
+    None). Returns the seconds it took. """
+    if ticks is None:
+      ticks = self.replay.ticks
+    self.timings = {"Updater.update_all": 0.0, "Character.update": 0.0}
 
-        elapsed time: %s
+    start = time.time()
+    for x in range(ticks):
+      if self.replay is not None and self.replay.done():
+        break
 
-        deaths: %d
+      self.tick(self.read_input())
+      UpKeys.flush()
+      self.clock.ticked()
 
-        percentage complete (gold): %d%%""" % (elapsed, DEATH_COUNT, int(100 * self.char.gold / 7))
+      if draw:
+        self.draw()
+        self.clock.drew()
 
-        my_rect = self.buff.get_rect()
-        self.buff = render_textrect(gameover, my_font, my_rect, (10, 10, 10), (210, 255, 255), True, 0)
+    return time.time() - start
 
-      blackness2 = pygame.Surface((ABS_MAP_SIZE * 2, ABS_MAP_SIZE * 2))
-      blackness2.set_alpha(255)
-      self.screen.blit(blackness2, blackness2.get_rect())
+  def loop(self):
+    # self.set_state(States.GameOver)
 
+    while 1:
+      for event in pygame.event.get():
+        if event.type == pygame.QUIT: 
+          print self.finish()
+          pygame.display.quit()
+          exit(0)
+        if event.type == pygame.KEYUP:
+          UpKeys.add_key(event.key)
 
-      self.screen.blit(pygame.transform.scale(self.buff, (ABS_MAP_SIZE * GAME_SIZE, ABS_MAP_SIZE * GAME_SIZE)), self.buff.get_rect())
-      UpKeys.flush()
-      time.sleep(.02)
-      pygame.display.flip()
+      # Key ups stick around until a tick has had the chance to see them.
+      for x in range(self.clock.ticks_due()):
+        if self.replay is not None and self.replay.done():
+          print self.finish()
+          pygame.display.quit()
+          exit(0)
 
-g = Game()
-g.loop()
+        self.tick(self.read_input())
+        UpKeys.flush()
+        self.clock.ticked()
+
+      if self.clock.should_draw():
+        self.draw()
+        if self.clock.drew() and SHOW_STATS:
+          pygame.display.set_caption(self.clock.report())
+
+      self.clock.wait()
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Escape Artist")
+  parser.add_argument("--headless", action="store_true", help="no window, no sound, run as fast as possible")
+  parser.add_argument("--seed", type=int, help="seed the random number generator")
+  parser.add_argument("--ticks", type=int, help="how many ticks to run when headless (default: 3000, or the whole replay)")
+  parser.add_argument("--draw", action="store_true", help="draw every tick when headless")
+  parser.add_argument("--record", metavar="FILE", help="record input to FILE")
+  parser.add_argument("--replay", metavar="FILE", help="play back input recorded to FILE")
+  args, unknown = parser.parse_known_args() # py2app likes to add its own arguments
+
+  g = Game(args.headless, args.seed, args.record, args.replay)
+
+  if args.headless:
+    ticks = args.ticks
+    if ticks is None and args.replay is None:
+      ticks = 3000
+
+    g.run_headless(ticks, args.draw)
+    print g.finish()
+    for name, total in sorted(g.timings.items()):
+      print "  %s: %.3fms/tick" % (name, 1000 * total / max(g.clock.total_ticks, 1))
+  else:
+    g.loop()
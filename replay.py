@@ -0,0 +1,90 @@
+import struct
+import pygame
+
+MAGIC = "LD21"
+VERSION = 1
+
+# Every key the game ever looks at, in bit order. Nothing else gets recorded.
+KEYS = [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN,
+        pygame.K_x, pygame.K_z, pygame.K_ESCAPE, pygame.K_s, pygame.K_q]
+
+HEADER = struct.Struct("<4sHI") # magic, version, random seed
+RUN = struct.Struct("<HHH")     # how many ticks in a row, held keys, released keys
+
+def to_bits(pressed):
+  """ pressed: anything that can answer pressed[key] for the keys in KEYS. """
+  bits = 0
+  for i, key in enumerate(KEYS):
+    if pressed[key]:
+      bits |= 1 << i
+  return bits
+
+class RecordedKeys:
+  """ Quacks like pygame.key.get_pressed(), but for a recorded tick. """
+  def __init__(self, bits):
+    self.bits = bits
+
+  def __getitem__(self, key):
+    if key not in KEYS:
+      return False
+    return (self.bits >> KEYS.index(key)) & 1
+
+class InputRecorder:
+  """ Writes down the keys held and released on every tick. Runs of identical
+  ticks (which is most of them) are stored once with a count. """
+  def __init__(self, file_name, seed):
+    self.file = open(file_name, "wb")
+    self.file.write(HEADER.pack(MAGIC, VERSION, seed))
+    self.run = None
+    self.count = 0
+
+  def record(self, pressed, released):
+    """ pressed: the keys for this tick. released: the UpKeys list for it. """
+    run = (to_bits(pressed), to_bits(dict((key, key in released) for key in KEYS)))
+    if run == self.run and self.count < 0xFFFF:
+      self.count += 1
+      return
+
+    self.write_run()
+    self.run = run
+    self.count = 1
+
+  def write_run(self):
+    if self.count > 0:
+      self.file.write(RUN.pack(self.count, *self.run))
+
+  def close(self):
+    self.write_run()
+    self.count = 0
+    self.file.close()
+
+class InputReplay:
+  """ Plays an InputRecorder log back one tick at a time. """
+  def __init__(self, file_name):
+    data = open(file_name, "rb").read()
+    if len(data) < HEADER.size:
+      raise ValueError("%s is not an input recording." % file_name)
+
+    magic, version, self.seed = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("%s is not a version %d input recording." % (file_name, VERSION))
+
+    self.runs = [RUN.unpack_from(data, offset) for offset in range(HEADER.size, len(data), RUN.size)]
+    self.ticks = sum(run[0] for run in self.runs)
+    self.run = 0
+    self.left = self.runs[0][0] if self.runs else 0
+
+  def done(self):
+    return self.run >= len(self.runs)
+
+  def next(self):
+    """ Returns the keys held and the list of keys released for the next tick. """
+    count, held, released = self.runs[self.run]
+
+    self.left -= 1
+    if self.left == 0:
+      self.run += 1
+      if self.run < len(self.runs):
+        self.left = self.runs[self.run][0]
+
+    return RecordedKeys(held), [key for i, key in enumerate(KEYS) if (released >> i) & 1]
@@ -6,7 +6,81 @@ class TextRectException:
     def __str__(self):
         return self.message
 
-def render_textrect(string, font, rect, text_color, background_color, fuzzy=False, justification=0):
+def fits(text, estimate, pieces, font, width):
+    """Is text narrower than width? estimate is the sum of the widths of the
+    pieces text was glued together from. Glued together, text can come out a
+    pixel per piece narrower than that (kerning and rounding) but never wider,
+    so we only have to ask the font when it's close."""
+    if estimate < width:
+        return True
+    if estimate - pieces >= width:
+        return False
+    return font.size(text)[0] < width
+
+def wrap_text(string, font, width):
+    """Word-wraps string so every line is narrower than width. Each word (and
+    the space) is only measured once. \n begins a new line.
+
+    Returns a list of (line, line_width) pairs, where line_width is an estimate
+    that's at most a few pixels too big. Raises a TextRectException if a word
+    is too long to fit on a line by itself."""
+
+    space = font.size(" ")[0]
+    widths = {}
+
+    final_lines = []
+
+    for requested_line in string.splitlines():
+        words = requested_line.split(' ')
+        for word in words:
+            if word not in widths:
+                widths[word] = font.size(word)[0]
+
+        line_width = sum(widths[word] for word in words) + space * (len(words) - 1)
+        if fits(requested_line, line_width, 2 * len(words), font, width + 1):
+            final_lines.append((requested_line, line_width))
+            continue
+
+        # if any of our words are too long to fit, return.
+        for word in words:
+            if widths[word] >= width:
+                raise TextRectException, "The word " + word + " is too long to fit in the rect passed."
+
+        # Build the line while the words fit.
+        line = []
+        line_width = 0
+        for word in words:
+            test_width = line_width + widths[word] + space
+            test_line = line + [word]
+            if fits(" ".join(test_line) + " ", test_width, 2 * len(test_line), font, width):
+                line = test_line
+                line_width = test_width
+            else:
+                final_lines.append((" ".join(line) + " " if line else "", line_width))
+                line = [word]
+                line_width = widths[word] + space
+        final_lines.append((" ".join(line) + " " if line else "", line_width))
+
+    return final_lines
+
+def layout_textrect(string, font, rect):
+    """Works out where the lines of string go in rect, without drawing
+    anything. Returns (lines, line_heights) where lines is what wrap_text
+    gives back. Raises a TextRectException if the text won't fit."""
+
+    lines = wrap_text(string, font, rect.width)
+
+    # Lines with descenders (and some wide glyphs) come out a pixel taller
+    # than font.get_height(), and each line moves the next one down by its own
+    # height.
+    line_heights = [font.size(line)[1] for line, line_width in lines]
+
+    if lines and sum(line_heights) >= rect.height:
+        raise TextRectException, "Once word-wrapped, the text string was too tall to fit in the rect."
+
+    return lines, line_heights
+
+def render_textrect(string, font, rect, text_color, background_color, fuzzy=False, justification=0, layout=None):
     """Returns a surface containing the passed text string, reformatted
     to fit within the given rect, word-wrapping as necessary. The text
     will be anti-aliased.
@@ -22,6 +96,8 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
     justification - 0 (default) left-justified
                     1 horizontally centered
                     2 right-justified
+    layout - what layout_textrect gave back for this string, font and rect,
+             if you already have it.
 
     Returns the following values:
 
@@ -30,34 +106,10 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
     """
 
     import pygame
-    
-    final_lines = []
 
-    requested_lines = string.splitlines()
-
-    # Create a series of lines that will fit on the provided
-    # rectangle.
-
-    for requested_line in requested_lines:
-        if font.size(requested_line)[0] > rect.width:
-            words = requested_line.split(' ')
-            # if any of our words are too long to fit, return.
-            for word in words:
-                if font.size(word)[0] >= rect.width:
-                    raise TextRectException, "The word " + word + " is too long to fit in the rect passed."
-            # Start a new line
-            accumulated_line = ""
-            for word in words:
-                test_line = accumulated_line + word + " "
-                # Build the line while the words fit.    
-                if font.size(test_line)[0] < rect.width:
-                    accumulated_line = test_line 
-                else: 
-                    final_lines.append(accumulated_line) 
-                    accumulated_line = word + " " 
-            final_lines.append(accumulated_line)
-        else: 
-            final_lines.append(requested_line) 
+    if layout is None:
+        layout = layout_textrect(string, font, rect)
+    lines, line_heights = layout
 
     # Let's try to write the text out on the surface.
 
@@ -67,9 +119,7 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
       surface.set_colorkey(background_color)
 
     accumulated_height = 0 
-    for line in final_lines: 
-        if accumulated_height + font.size(line)[1] >= rect.height:
-            raise TextRectException, "Once word-wrapped, the text string was too tall to fit in the rect."
+    for (line, line_width), line_height in zip(lines, line_heights):
         if line != "":
             tempsurface = font.render(line, fuzzy, text_color)
             if justification == 0:
@@ -80,6 +130,6 @@ def render_textrect(string, font, rect, text_color, background_color, fuzzy=Fals
                 surface.blit(tempsurface, (rect.width - tempsurface.get_width(), accumulated_height))
             else:
                 raise TextRectException, "Invalid justification argument: " + str(justification)
-        accumulated_height += font.size(line)[1]
+        accumulated_height += line_height
 
     return surface